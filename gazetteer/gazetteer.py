@@ -18,9 +18,13 @@ from __future__ import print_function
 import os
 import csv
 import re
+import hashlib
 import logging
 import optparse
 import random
+import tempfile
+
+import numpy
 
 import dedupe
 from unidecode import unidecode
@@ -52,6 +56,14 @@ training_file = 'data_matching_training.json'
 messy_path = "AC_unmatched_usm3.csv"
 canonical_path = "AC_suppliers.csv"
 
+# Cleaned csvs are cached here, see readData. CACHE_TAG keeps these
+# caches apart from the record linkage script's, as each script has its
+# own preProcess and PREPROCESS_VERSION: bump the version whenever
+# preProcess below changes.
+cache_dir = 'preprocess_cache'
+CACHE_TAG = 'gazetteer'
+PREPROCESS_VERSION = 1
+
 
 def preProcess(column):
     """
@@ -73,19 +85,108 @@ def preProcess(column):
     return column
 
 
+# cachePath, writeCache and readCache are the same in gazetteer.py and
+# spendnetwork_record_linkage_example.py, so make any fix in both.
+
+def cachePath(filename):
+    """
+    Work out where the cleaned copy of a CSV lives. The name includes a
+    hash of the file's contents, CACHE_TAG and PREPROCESS_VERSION, so a
+    changed input file or different cleaning gives a different cache file.
+    """
+
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+
+    return os.path.join(cache_dir, '{}.{}.{}.v{}.npz'.format(
+        os.path.basename(filename), CACHE_TAG, sha.hexdigest(),
+        PREPROCESS_VERSION))
+
+
+def writeCache(cache_path, columns, rows):
+    """
+    Save cleaned rows column by column, each as one block of UTF-8 bytes
+    plus an offsets array marking where each cell starts, so cells take
+    up no more space than their own text. Missing values get a separate
+    mask so they come back as None.
+    """
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    arrays = {'columns': numpy.array(columns, dtype=str)}
+    for j in range(len(columns)):
+        cells = [row[j] for row in rows]
+        encoded = [b'' if v is None else v.encode('utf8') for v in cells]
+        arrays['values_{}'.format(j)] = numpy.frombuffer(b''.join(encoded),
+                                                         dtype=numpy.uint8)
+        arrays['offsets_{}'.format(j)] = numpy.cumsum(
+            [0] + [len(v) for v in encoded], dtype=numpy.int64)
+        arrays['missing_{}'.format(j)] = numpy.array(
+            [v is None for v in cells], dtype=bool)
+
+    # write to a temporary file first so an interrupted run (or two runs
+    # at once) can't leave a half written cache behind
+    f = tempfile.NamedTemporaryFile(dir=cache_dir, delete=False)
+    try:
+        with f:
+            numpy.savez(f, **arrays)
+        os.replace(f.name, cache_path)
+    except BaseException:
+        os.remove(f.name)
+        raise
+
+
+def readCache(cache_path, filename):
+    """
+    Load the records saved by writeCache, keyed the same way as readData.
+    """
+
+    with numpy.load(cache_path) as cache:
+        columns = cache['columns'].tolist()
+        column_values = []
+        for j in range(len(columns)):
+            buf = cache['values_{}'.format(j)].tobytes()
+            offsets = cache['offsets_{}'.format(j)].tolist()
+            missing = cache['missing_{}'.format(j)].tolist()
+            column_values.append([
+                None if m else buf[start:end].decode('utf8')
+                for start, end, m in zip(offsets, offsets[1:], missing)])
+
+    data_d = {}
+    for i, row in enumerate(zip(*column_values)):
+        data_d[filename + str(i)] = dict(zip(columns, row))
+
+    return data_d
+
+
 def readData(filename):
     """
     Read in our data from a CSV file and create a dictionary of records, 
     where the key is a unique record ID.
+    If the file has been read before, the cleaned records are loaded from
+    the cache instead.
     """
 
+    cache_path = cachePath(filename)
+    if os.path.exists(cache_path):
+        print('reading cleaned', filename, 'from', cache_path)
+        return readCache(cache_path, filename)
+
     data_d = {}
+    rows = []
 
     with open(filename) as f:
         reader = csv.DictReader(f)
+        columns = reader.fieldnames or []
         for i, row in enumerate(reader):
-            clean_row = dict([(k, preProcess(v)) for (k, v) in row.items()])
-            data_d[filename + str(i)] = dict(clean_row)
+            clean_row = [preProcess(row[k]) for k in columns]
+            rows.append(clean_row)
+            data_d[filename + str(i)] = dict(zip(columns, clean_row))
+
+    writeCache(cache_path, columns, rows)
 
     return data_d
 
@@ -17,8 +17,12 @@ import os
 import csv
 import re
 import collections
+import hashlib
+import heapq
+import itertools
 import logging
 import optparse
+import tempfile
 import numpy
 
 import dedupe
@@ -32,7 +36,17 @@ optp = optparse.OptionParser()
 optp.add_option('-v', '--verbose', dest='verbose', action='count',
                 help='Increase verbosity (specify multiple times for more)'
                 )
+optp.add_option('-k', '--top-k', dest='top_k', type='int',
+                help='Only keep the best K candidates for each usm3 record '
+                     'before the 1:1 assignment (default: keep every pair)'
+                )
+optp.add_option('-f', '--score-floor', dest='score_floor', type='float',
+                default=0.0,
+                help='Drop candidate pairs scoring below this (default: 0)'
+                )
 (opts, args) = optp.parse_args()
+if opts.top_k is not None and opts.top_k < 1:
+    optp.error('--top-k must be at least 1')
 log_level = logging.WARNING 
 if opts.verbose :
     if opts.verbose == 1:
@@ -51,6 +65,15 @@ training_file = 'data_matching_training.json'
 data_1_path = 'AC_unmatched_usm3.csv'
 data_0_path = 'AC_suppliers.csv'
 
+# Cleaned copies of the input csvs are cached here so later runs can skip
+# the csv parsing and preProcess. CACHE_TAG and PREPROCESS_VERSION go into
+# the cache file names, so this script never picks up caches made by the
+# gazetteer script's preProcess. Bump PREPROCESS_VERSION whenever
+# preProcess below changes so the old caches are ignored.
+cache_dir = 'preprocess_cache'
+CACHE_TAG = 'linkage'
+PREPROCESS_VERSION = 1
+
 def preProcess(column):
     """
     Do a little bit of data cleaning with the help of Unidecode and Regex.
@@ -71,24 +94,167 @@ def preProcess(column):
     return column
 
 
+# cachePath, writeCache and readCache are the same in gazetteer.py and
+# spendnetwork_record_linkage_example.py, so make any fix in both.
+
+def cachePath(filename):
+    """
+    Work out where the cleaned copy of a CSV lives. The name includes a
+    hash of the file's contents, CACHE_TAG and PREPROCESS_VERSION, so a
+    changed input file or different cleaning gives a different cache file.
+    """
+
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+
+    return os.path.join(cache_dir, '{}.{}.{}.v{}.npz'.format(
+        os.path.basename(filename), CACHE_TAG, sha.hexdigest(),
+        PREPROCESS_VERSION))
+
+
+def writeCache(cache_path, columns, rows):
+    """
+    Save cleaned rows column by column, each as one block of UTF-8 bytes
+    plus an offsets array marking where each cell starts, so cells take
+    up no more space than their own text. Missing values get a separate
+    mask so they come back as None.
+    """
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    arrays = {'columns': numpy.array(columns, dtype=str)}
+    for j in range(len(columns)):
+        cells = [row[j] for row in rows]
+        encoded = [b'' if v is None else v.encode('utf8') for v in cells]
+        arrays['values_{}'.format(j)] = numpy.frombuffer(b''.join(encoded),
+                                                         dtype=numpy.uint8)
+        arrays['offsets_{}'.format(j)] = numpy.cumsum(
+            [0] + [len(v) for v in encoded], dtype=numpy.int64)
+        arrays['missing_{}'.format(j)] = numpy.array(
+            [v is None for v in cells], dtype=bool)
+
+    # write to a temporary file first so an interrupted run (or two runs
+    # at once) can't leave a half written cache behind
+    f = tempfile.NamedTemporaryFile(dir=cache_dir, delete=False)
+    try:
+        with f:
+            numpy.savez(f, **arrays)
+        os.replace(f.name, cache_path)
+    except BaseException:
+        os.remove(f.name)
+        raise
+
+
+def readCache(cache_path, filename):
+    """
+    Load the records saved by writeCache, keyed the same way as readData.
+    """
+
+    with numpy.load(cache_path) as cache:
+        columns = cache['columns'].tolist()
+        column_values = []
+        for j in range(len(columns)):
+            buf = cache['values_{}'.format(j)].tobytes()
+            offsets = cache['offsets_{}'.format(j)].tolist()
+            missing = cache['missing_{}'.format(j)].tolist()
+            column_values.append([
+                None if m else buf[start:end].decode('utf8')
+                for start, end, m in zip(offsets, offsets[1:], missing)])
+
+    data_d = {}
+    for i, row in enumerate(zip(*column_values)):
+        data_d[filename + str(i)] = dict(zip(columns, row))
+
+    return data_d
+
+
 def readData(filename):
     """
     Read in our data from a CSV file and create a dictionary of records, 
     where the key is a unique record ID.
+    If the file has been read before, the cleaned records are loaded from
+    the cache instead.
     """
 
+    cache_path = cachePath(filename)
+    if os.path.exists(cache_path):
+        print('reading cleaned', filename, 'from', cache_path)
+        return readCache(cache_path, filename)
+
     data_d = {}
+    rows = []
 
     with open(filename) as f:
         reader = csv.DictReader(f)
+        columns = reader.fieldnames or []
         for i, row in enumerate(reader):
-            clean_row = dict([(k, preProcess(v)) for (k, v) in row.items()])
+            clean_row = [preProcess(row[k]) for k in columns]
             # if clean_row['price'] :
             #     clean_row['price'] = float(clean_row['price'][1:])
-            data_d[filename + str(i)] = dict(clean_row)
+            rows.append(clean_row)
+            data_d[filename + str(i)] = dict(zip(columns, clean_row))
+
+    writeCache(cache_path, columns, rows)
 
     return data_d
 
+
+def prunedMatch(linker, data_1, data_2, top_k, score_floor=0.0, batch_size=1000):
+    """
+    Like linker.match, but only keeps the best top_k candidates for each
+    record in data_1 while scoring, and drops pairs below score_floor
+    straight away. The 1:1 assignment then only has to look at those.
+
+    Blocks are scored batch_size at a time (the same way dedupe's
+    matchBlocks scores them) so the full set of scored pairs never has
+    to be held in memory at once. Each block holds one data_1 record and
+    all of its candidates, so a batch always has every pair for its records.
+    """
+
+    kept = []
+    dtype = None
+
+    blocks = linker._blockData(data_1, data_2)
+    while True:
+        batch = list(itertools.islice(blocks, batch_size))
+        if not batch:
+            break
+
+        candidate_records = itertools.chain.from_iterable(
+            linker._blockedPairs(batch))
+        scored = dedupe.core.scoreDuplicates(candidate_records,
+                                             linker.data_model,
+                                             linker.classifier,
+                                             linker.num_cores,
+                                             threshold=0)
+        if not len(scored):
+            continue
+        dtype = scored.dtype
+
+        # filter here rather than in scoreDuplicates, which only keeps
+        # score > threshold, so pairs exactly on the floor are kept the
+        # same way linker.match keeps them
+        by_record = collections.defaultdict(list)
+        for (id_1, id_2), score in scored:
+            score = float(score)
+            if score >= score_floor:
+                by_record[id_1].append((score, id_2))
+
+        for id_1, candidates in by_record.items():
+            for score, id_2 in heapq.nlargest(top_k, candidates):
+                kept.append(((id_1, id_2), score))
+
+    if dtype is None:
+        return []
+
+    pruned = numpy.array(kept, dtype=dtype)
+    print('# candidate pairs kept', len(pruned))
+
+    return list(dedupe.clustering.greedyMatching(pruned, threshold=score_floor))
+
     
 print('importing data ...')
 data_1 = readData(data_1_path)  #NOTE: later on 0 will be the usm3 unmatched and 1 will be the suppliers
@@ -163,8 +329,16 @@ else:
 # If we had more data, we would not pass in all the blocked data into
 # this function but a representative sample.
 
+# With --top-k, only the best few candidates for each usm3 record are kept
+# while scoring, which saves a lot of memory and assignment time on the
+# full supplier tables.
+
 print('clustering...')
-linked_records = linker.match(data_1, data_2, 0)
+if opts.top_k is not None :
+    linked_records = prunedMatch(linker, data_1, data_2,
+                                 opts.top_k, opts.score_floor)
+else :
+    linked_records = linker.match(data_1, data_2, opts.score_floor)
 
 print('# duplicate sets', len(linked_records))
 